@@ -1,10 +1,20 @@
 import os
+import sys
 import asyncio
+import threading
 import time
+import traceback
 import aiohttp
 from twitchio.ext import commands
 import json
+import re
+import codecs
+import heapq
+import itertools
+import math
 import unicodedata
+from collections import deque
+from rapidfuzz import fuzz
 
 # --- Railway Env Vars ---
 TOKEN               = os.getenv("TOKEN")               # Twitch user token for IRC (must start with oauth:)
@@ -18,14 +28,129 @@ SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
 SPOTIFY_REFRESH_TOKEN = os.getenv("SPOTIFY_REFRESH_TOKEN")
 
 POLL_SECONDS = int(os.getenv("SPOTIFY_POLL_SECONDS", "5"))
+# Now-playing history kept in memory for !song / !lastsongs (optional JSON file to survive restarts)
+SONG_HISTORY_SIZE = int(os.getenv("SONG_HISTORY_SIZE", "20"))
+SONG_HISTORY_FILE = os.getenv("SONG_HISTORY_FILE")
 
 PLATFORM = os.getenv("PLATFORM", "common-gen5")   # EA Pro Clubs platform
+# Platforms searched in parallel by !versus (comma separated); PLATFORM is always included
+EA_PLATFORMS = list(dict.fromkeys(
+    p.strip() for p in [PLATFORM, *os.getenv("EA_PLATFORMS", "common-gen5,common-gen4").split(",")] if p.strip()
+))
 DISABLE_VERSUS = os.getenv("DISABLE_VERSUS", "0").lower() in ("1", "true", "yes", "on")
+# Admission control for EA-bound commands: concurrent workers + bounded wait queue
+EA_WORKERS = int(os.getenv("EA_WORKERS", "3"))
+EA_QUEUE_SIZE = int(os.getenv("EA_QUEUE_SIZE", "12"))
 
 DISCORD_WEBHOOK_URL = os.getenv("DISCORD_WEBHOOK_URL")
 # Optional: seconds to keep the message before auto-delete (0 = keep)
 DISCORD_WEBHOOK_TTL_SECONDS = int(os.getenv("DISCORD_WEBHOOK_TTL_SECONDS", "0"))
 
+# Report event-loop stalls longer than this (ms); 0 disables the lag monitor
+LOOP_LAG_THRESHOLD_MS = int(os.getenv("LOOP_LAG_THRESHOLD_MS", "250"))
+
+# --- Supervised background tasks ---
+class TaskSupervisor:
+    def __init__(self):
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    def spawn(self, name: str, factory, restart: bool = True, max_backoff: float = 60.0) -> asyncio.Task:
+        """
+        Run factory() (a coroutine function) as a named, tracked task.
+        restart=True re-runs it with exponential backoff whenever it exits or crashes.
+        Spawning a name that is still running returns the existing task.
+        """
+        existing = self._tasks.get(name)
+        if existing and not existing.done():
+            return existing
+        task = asyncio.create_task(self._run(name, factory, restart, max_backoff), name=name)
+        self._tasks[name] = task
+        task.add_done_callback(lambda t: self._tasks.pop(name, None) if self._tasks.get(name) is t else None)
+        return task
+
+    async def _run(self, name: str, factory, restart: bool, max_backoff: float):
+        backoff = 1.0
+        while True:
+            started = time.monotonic()
+            try:
+                await factory()
+                if not restart:
+                    return
+                print(f"[Supervisor] {name} exited")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[Supervisor] {name} crashed: {type(e).__name__}: {e}")
+                traceback.print_exc()
+                if not restart:
+                    return
+            if time.monotonic() - started > 60:
+                backoff = 1.0   # it ran fine for a while; don't punish a one-off failure
+            print(f"[Supervisor] restarting {name} in {backoff:.0f}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, max_backoff)
+
+    def running(self) -> list[str]:
+        return sorted(n for n, t in self._tasks.items() if not t.done())
+
+    def is_running(self, name: str) -> bool:
+        t = self._tasks.get(name)
+        return bool(t and not t.done())
+
+# --- Event-loop lag monitor ---
+class LoopLagMonitor:
+    def __init__(self, threshold_ms: int = 250, interval_ms: int = 100):
+        """
+        A coroutine ticks every interval_ms; a watchdog thread notices when a tick is overdue
+        by threshold_ms and grabs the loop thread's stack while it is still blocked.
+        """
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self._beat = time.monotonic()
+        self._loop = None
+        self._loop_thread_id = None
+        self._stall_report = None       # (task name, stack) captured by the watchdog
+        self._thread = None
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._watchdog, name="loop-lag-watchdog", daemon=True)
+            self._thread.start()
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - self._beat - self.interval
+            if lag >= self.threshold:
+                report, self._stall_report = self._stall_report, None
+                if report:
+                    task_name, stack = report
+                    print(f"[LoopLag] event loop blocked ~{lag * 1000:.0f}ms (task: {task_name})\n{stack}")
+                else:
+                    print(f"[LoopLag] event loop blocked ~{lag * 1000:.0f}ms")
+
+    def _watchdog(self):
+        reported_beat = None
+        while True:
+            time.sleep(self.interval)
+            beat = self._beat
+            if beat == reported_beat or time.monotonic() - beat - self.interval < self.threshold:
+                continue
+            reported_beat = beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            try:
+                task = asyncio.current_task(self._loop)
+                task_name = task.get_name() if task else "?"
+            except Exception:
+                task_name = "?"
+            self._stall_report = (task_name, "".join(traceback.format_stack(frame)[-12:]))
+
+TASKS = TaskSupervisor()
+LOOP_MONITOR = LoopLagMonitor(LOOP_LAG_THRESHOLD_MS)
+
 async def notify_discord_online(bot_name: str, channels: list[str] | None = None):
     """
     Post a 'bot online' message to a Discord channel via webhook and auto-delete after TTL.
@@ -68,7 +193,8 @@ async def notify_discord_online(bot_name: str, channels: list[str] | None = None
                 except Exception as de:
                     print(f"[Discord delete] Failed: {de}")
 
-            asyncio.create_task(_delete_later(msg_id, DISCORD_WEBHOOK_TTL_SECONDS))
+            TASKS.spawn(f"discord-delete-{msg_id}",
+                        lambda: _delete_later(msg_id, DISCORD_WEBHOOK_TTL_SECONDS), restart=False)
 
     except Exception as e:
         print(f"[Discord notify] Failed: {e}")
@@ -131,150 +257,298 @@ def _parse_badges(badges_str: str | None) -> dict:
             out[k] = v or "1"
     return out
 
-def is_privileged(tags: dict) -> bool:
+def command_priority(tags: dict) -> int:
+    """EA queue priority for the chatter who sent these tags (lower runs first)."""
     badges = _parse_badges(tags.get("badges"))
-    is_broadcaster = "broadcaster" in badges or (
+    if "broadcaster" in badges or (
         tags.get("user-id") and tags.get("room-id") and tags["user-id"] == tags["room-id"]
-    )
-    is_mod = tags.get("mod") == "1" or "moderator" in badges
-    is_vip = "vip" in badges
-    return bool(is_broadcaster or is_mod or is_vip)
+    ):
+        return PRIO_BROADCASTER
+    if tags.get("mod") == "1" or "moderator" in badges:
+        return PRIO_MOD
+    if "vip" in badges:
+        return PRIO_VIP
+    return PRIO_VIEWER
+
+def is_privileged(tags: dict) -> bool:
+    return command_priority(tags) <= PRIO_VIP
 
 # --- Minimal IRC-over-WebSocket client to guarantee viewer-list presence ---
+IRC_WS_URL = "wss://irc-ws.chat.twitch.tv:443"
+IRC_KEEPALIVE_SECONDS = 10      # send our own PING after this much silence...
+IRC_PONG_TIMEOUT_SECONDS = 5    # ...and treat the socket as dead if nothing comes back
+IRC_JOIN_TIMEOUT_SECONDS = 10
+IRC_OVERLAP_SECONDS = 3         # keep the old connection reading this long after a RECONNECT handover
+IRC_MAX_BACKOFF_SECONDS = 15
+IRC_SEEN_IDS = 500              # message ids remembered for de-duplication during overlap
+
+class _IRCConnection:
+    def __init__(self, num: int, session: aiohttp.ClientSession, ws):
+        self.num = num
+        self.session = session
+        self.ws = ws
+        self.joined = asyncio.Event()
+        self.closed = asyncio.Event()
+        self.ping_sent = False
+        self.opened_at = time.monotonic()
+
+    async def send(self, line: str):
+        if not self.closed.is_set():
+            await self.ws.send_str(line + "\r\n")
+
+    async def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        try:
+            await self.ws.close()
+        finally:
+            await self.session.close()
+
 class SimpleIRCClient:
-    def __init__(self, token_oauth: str, login: str, channel: str):
+    def __init__(self, token_oauth: str, login: str, channel: str, history: "TrackHistory | None" = None):
         """
         token_oauth: the full token string including 'oauth:' prefix
         login: twitch username for the token (nick)
         channel: channel to join without '#'
+        history: now-playing history served by !song / !lastsongs
         """
         self.token_oauth = token_oauth
-        self.login = login
+        self.login = login.lower()
         self.channel = channel
-        self.ws = None
+        self.history = history
+        self._active: _IRCConnection | None = None
         self._running = False
+        self._greeted = False
+        self._conn_seq = itertools.count(1)
+        self._cmd_seq = itertools.count(1)
+        self._handover_task: asyncio.Task | None = None
+        self._seen_ids: deque[str] = deque(maxlen=IRC_SEEN_IDS)
+        self._seen_set: set[str] = set()
 
     async def connect_and_run(self):
         """
-        Persistent loop: connect, join, respond to PING, log messages, handle !ping.
-        Reconnects with backoff if disconnected.
+        Persistent loop: connect, join, keep alive with PINGs, log messages, handle commands.
+        Twitch RECONNECT notices are handled make-before-break (see _handover); a dead
+        socket is replaced right away, backing off only if reconnects keep failing.
         """
-        backoff = 1
+        backoff = 0
         self._running = True
         while self._running:
+            conn = None
             try:
-                async with aiohttp.ClientSession() as session:
-                    print("[IRC-WS] Connecting to wss://irc-ws.chat.twitch.tv:443 ...")
-                    async with session.ws_connect("wss://irc-ws.chat.twitch.tv:443") as ws:
-                        self.ws = ws
-                        # Request capabilities (membership to appear in viewer list, tags, commands)
-                        await self._send_raw("CAP REQ :twitch.tv/membership twitch.tv/tags twitch.tv/commands")
-                        await self._send_raw(f"PASS {self.token_oauth}")
-                        await self._send_raw(f"NICK {self.login}")
-                        await self._send_raw(f"JOIN #{self.channel}")
-                        print(f"[IRC-WS] Joined #{self.channel} as {self.login}")
-
-                        # Optional hello message via IRC
-                        await self.privmsg(f"👋 (IRC-WS) {self.login} connected.")
-
-                        backoff = 1  # reset backoff on success
-
-                        async for msg in ws:
-                            if msg.type == aiohttp.WSMsgType.TEXT:
-                                line = msg.data.rstrip("\r\n")
-                                print(f"[IRC RAW] {line}")
-
-                                # Respond to PING to keep the connection alive
-                                if line.startswith("PING "):
-                                    payload = line.split(" ", 1)[1]
-                                    await self._send_raw(f"PONG {payload}")
-                                    continue
-
-                                # Simple PRIVMSG parsing for !ping
-                                # Example: :user!user@user.tmi.twitch.tv PRIVMSG #channel :message text
-                                try:
-                                    if " PRIVMSG #" in line:
-                                        raw_for_parse = line
-                                        tags = {}
-                                        # If the line starts with @tags, split them off first
-                                        if raw_for_parse.startswith("@"):
-                                            tags_blob, raw_for_parse = raw_for_parse.split(" ", 1)
-                                            tags = parse_irc_tags(tags_blob[1:])
-                                    
-                                        # Now parse prefix/channel/message from the remaining part
-                                        prefix, rest = raw_for_parse.split(" PRIVMSG #", 1)
-                                        chan, msgtext = rest.split(" :", 1)
-                                        chan = chan.split(" ", 1)[0]
-                                        author = prefix.split("!", 1)[0][1:]
-                                        print(f"[IRC MSG] #{chan} <{author}> {msgtext}")
-                                    
-                                        text_raw = msgtext
-                                        text = unicodedata.normalize("NFKC", text_raw).strip()
-                                        lower = text.lower()
-                                    
-                                        if lower.startswith("!ping"):
-                                            await self.privmsg("pong")
-                                    
-                                        elif lower.startswith("!versus") or lower.startswith("!vs"):
-                                            if DISABLE_VERSUS:
-                                                await self.privmsg("⚠️ !vs/!versus is temporarily disabled.")
-                                                continue
-                                            allowed = is_privileged(tags)
-                                            print(f"[perm] {author} badges='{tags.get('badges')}' mod={tags.get('mod')} "
-                                                  f"user-id={tags.get('user-id')} room-id={tags.get('room-id')} -> allowed={allowed}")
-                                            if not allowed:
-                                                await self.privmsg("⛔ This command is for the broadcaster, moderators, or VIPs.")
-                                                return
-                                            parts = text.split(" ", 1)
-                                            argstr = parts[1] if len(parts) > 1 else ""
-                                            reply = await handle_versus_command(argstr)
-                                            await self.privmsg(reply)
-                                    
-                                        elif lower.startswith("!eahealth"):
-                                            parts = text.split(" ", 1)
-                                            test_id = (parts[1].strip() if len(parts) > 1 else "167054")  # your club ID as default
-                                            try:
-                                                async with aiohttp.ClientSession() as session:
-                                                    url = f"{EA_BASE}/clubs/overallStats?platform={PLATFORM}&clubIds={test_id}"
-                                                    data = await _http_json(session, url)
-                                                    ok = isinstance(data, list) and len(data) > 0 and "wins" in data[0]
-                                                    await self.privmsg("EA OK ✅" if ok else "EA responded, but structure unexpected ⚠️")
-                                            except Exception as e:
-                                                await self.privmsg("EA FAIL ❌ (see logs)")
-                                                print(f"[EAHealth Error] {e}")
-                                        
-                                        elif lower.startswith("!versus") or lower.startswith("!vs"):
-                                            if DISABLE_VERSUS:
-                                                await self.privmsg("⚠️ !vs/!versus is temporarily disabled.")
-                                                continue
-                                            # Extract args after the command
-                                            parts = text.split(" ", 1)
-                                            argstr = parts[1] if len(parts) > 1 else ""
-                                            reply = await handle_versus_command(argstr)
-                                            # keep replies short for Twitch; we already truncate in formatter
-                                            await self.privmsg(reply)
-                                except Exception as e:
-                                    print(f"[IRC-WS Parse Error] {e}")
-
-                            elif msg.type == aiohttp.WSMsgType.ERROR:
-                                print(f"[IRC-WS] WebSocket error: {msg.data}")
-                                break
-                            elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.CLOSE):
-                                print("[IRC-WS] WebSocket closed by server.")
-                                break
-
+                conn = await self._connect()
+                self._active = conn
+
+                # Optional hello message via IRC (once per process, not on every reconnect)
+                if not self._greeted:
+                    self._greeted = True
+                    await self.privmsg(f"👋 (IRC-WS) {self.login} connected.")
+
+                # Follow the active connection across RECONNECT handovers
+                while self._running:
+                    await conn.closed.wait()
+                    if self._handover_task is not None and not self._handover_task.done():
+                        await asyncio.wait([self._handover_task])
+                    if self._active is conn or self._active.closed.is_set():
+                        break
+                    conn = self._active
             except Exception as e:
                 print(f"[IRC-WS] Connection error: {e}")
 
-            # Reconnect with exponential backoff
-            if self._running:
+            if not self._running:
+                break
+            if conn is not None and time.monotonic() - conn.opened_at > 60:
+                backoff = 0     # that connection was healthy; reconnect immediately
+            if backoff:
                 print(f"[IRC-WS] Reconnecting in {backoff}s ...")
                 await asyncio.sleep(backoff)
-                backoff = min(backoff * 2, 60)
+            else:
+                print("[IRC-WS] Reconnecting ...")
+            backoff = min(max(backoff * 2, 1), IRC_MAX_BACKOFF_SECONDS)
+
+    async def _connect(self) -> _IRCConnection:
+        """Open a new socket, authenticate and wait until the channel is joined."""
+        num = next(self._conn_seq)
+        print(f"[IRC-WS] #{num} connecting to {IRC_WS_URL} ...")
+        session = aiohttp.ClientSession()
+        try:
+            ws = await session.ws_connect(IRC_WS_URL)
+        except Exception:
+            await session.close()
+            raise
+        conn = _IRCConnection(num, session, ws)
+        TASKS.spawn(f"irc-ws-reader-{num}", lambda: self._read_loop(conn), restart=False)
+
+        # Request capabilities (membership to appear in viewer list, tags, commands)
+        await conn.send("CAP REQ :twitch.tv/membership twitch.tv/tags twitch.tv/commands")
+        await conn.send(f"PASS {self.token_oauth}")
+        await conn.send(f"NICK {self.login}")
+        await conn.send(f"JOIN #{self.channel}")
+
+        waiters = [asyncio.ensure_future(conn.joined.wait()), asyncio.ensure_future(conn.closed.wait())]
+        try:
+            await asyncio.wait(waiters, timeout=IRC_JOIN_TIMEOUT_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for w in waiters:
+                w.cancel()
+        if not conn.joined.is_set() or conn.closed.is_set():
+            await conn.close()
+            raise RuntimeError(f"#{num} did not join #{self.channel}")
+        print(f"[IRC-WS] #{num} joined #{self.channel} as {self.login}")
+        return conn
+
+    async def _handover(self, old: _IRCConnection):
+        """Make-before-break: join on a new socket, switch sends to it, then retire the old one."""
+        try:
+            new = await self._connect()
+        except Exception as e:
+            print(f"[IRC-WS] Handover failed ({e}); staying on #{old.num} until it closes")
+            return
+        self._active = new
+        print(f"[IRC-WS] Handed over #{old.num} -> #{new.num}")
+        if not old.closed.is_set():
+            await asyncio.sleep(IRC_OVERLAP_SECONDS)    # duplicates during the overlap are dropped by id
+            await old.close()
+
+    async def _read_loop(self, conn: _IRCConnection):
+        try:
+            while self._running and not conn.closed.is_set():
+                timeout = IRC_PONG_TIMEOUT_SECONDS if conn.ping_sent else IRC_KEEPALIVE_SECONDS
+                try:
+                    msg = await conn.ws.receive(timeout=timeout)
+                except asyncio.TimeoutError:
+                    if conn.ping_sent:
+                        print(f"[IRC-WS] #{conn.num} no reply to keepalive PING; connection is dead")
+                        break
+                    await conn.send("PING :tmi.twitch.tv")
+                    conn.ping_sent = True
+                    continue
+                conn.ping_sent = False
+
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    # One frame can carry several IRC lines
+                    for line in msg.data.split("\r\n"):
+                        if line:
+                            await self._handle_line(conn, line)
+                elif msg.type == aiohttp.WSMsgType.ERROR:
+                    print(f"[IRC-WS] #{conn.num} WebSocket error: {conn.ws.exception()}")
+                    break
+                elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING):
+                    if conn is self._active:
+                        print(f"[IRC-WS] #{conn.num} WebSocket closed by server.")
+                    break
+        finally:
+            await conn.close()
+
+    async def _handle_line(self, conn: _IRCConnection, line: str):
+        print(f"[IRC RAW] {line}")
+
+        # Respond to PING to keep the connection alive
+        if line.startswith("PING "):
+            payload = line.split(" ", 1)[1]
+            await conn.send(f"PONG {payload}")
+            return
+
+        # Strip tags/prefix to get at the command word
+        rest = line.split(" ", 1)[1] if line.startswith("@") else line
+        parts = rest.split(" ", 2)
+        command = parts[1] if rest.startswith(":") and len(parts) > 1 else parts[0]
+
+        if command == "RECONNECT":
+            self._handover_task = TASKS.spawn("irc-ws-handover", lambda: self._handover(conn), restart=False)
+        elif command == "ROOMSTATE" or (command == "JOIN" and rest.startswith(f":{self.login}!")):
+            conn.joined.set()
+            if self._active is None or self._active.closed.is_set():
+                self._active = conn     # nothing else can send; don't wait for _connect() to return
+        elif command == "PRIVMSG":
+            self._handle_privmsg(line)
+
+    def _already_seen(self, msg_id: str) -> bool:
+        if msg_id in self._seen_set:
+            return True
+        if len(self._seen_ids) == self._seen_ids.maxlen:
+            self._seen_set.discard(self._seen_ids[0])
+        self._seen_ids.append(msg_id)
+        self._seen_set.add(msg_id)
+        return False
+
+    def _handle_privmsg(self, line: str):
+        # Example: @tags :user!user@user.tmi.twitch.tv PRIVMSG #channel :message text
+        try:
+            raw_for_parse = line
+            tags = {}
+            # If the line starts with @tags, split them off first
+            if raw_for_parse.startswith("@"):
+                tags_blob, raw_for_parse = raw_for_parse.split(" ", 1)
+                tags = parse_irc_tags(tags_blob[1:])
+
+            # Both connections deliver the same message during a RECONNECT overlap
+            msg_id = tags.get("id")
+            if msg_id and self._already_seen(msg_id):
+                return
+
+            # Now parse prefix/channel/message from the remaining part
+            prefix, rest = raw_for_parse.split(" PRIVMSG #", 1)
+            chan, msgtext = rest.split(" :", 1)
+            chan = chan.split(" ", 1)[0]
+            author = prefix.split("!", 1)[0][1:]
+            print(f"[IRC MSG] #{chan} <{author}> {msgtext}")
+        except Exception as e:
+            print(f"[IRC-WS Parse Error] {e}")
+            return
+
+        if msgtext.lstrip().startswith("!"):
+            # Commands run off the read loop so slow EA lookups never delay PING/PONG
+            TASKS.spawn(f"irc-cmd-{next(self._cmd_seq)}",
+                        lambda: self._handle_command(msgtext, tags, author), restart=False)
+
+    async def _handle_command(self, text_raw: str, tags: dict, author: str):
+        try:
+            text = unicodedata.normalize("NFKC", text_raw).strip()
+            lower = text.lower()
+            cmd = lower.split(" ", 1)[0]
+
+            if lower.startswith("!ping"):
+                await self.privmsg("pong")
+
+            elif cmd == "!lastsongs":
+                if self.history is not None:
+                    await self.privmsg(format_lastsongs_reply(self.history))
+
+            elif cmd == "!song":     # exact word: leave !songrequest etc. to other bots
+                if self.history is not None:
+                    await self.privmsg(format_song_reply(self.history))
+
+            elif lower.startswith("!versus") or lower.startswith("!vs"):
+                if DISABLE_VERSUS:
+                    await self.privmsg("⚠️ !vs/!versus is temporarily disabled.")
+                    return
+                allowed = is_privileged(tags)
+                print(f"[perm] {author} badges='{tags.get('badges')}' mod={tags.get('mod')} "
+                      f"user-id={tags.get('user-id')} room-id={tags.get('room-id')} -> allowed={allowed}")
+                if not allowed:
+                    await self.privmsg("⛔ This command is for the broadcaster, moderators, or VIPs.")
+                    return
+                parts = text.split(" ", 1)
+                argstr = parts[1] if len(parts) > 1 else ""
+                reply = await EA_POOL.run(lambda: handle_versus_command(argstr),
+                                          command_priority(tags))
+                # keep replies short for Twitch; we already truncate in formatter
+                await self.privmsg(reply)
+
+            elif lower.startswith("!eahealth"):
+                parts = text.split(" ", 1)
+                test_id = (parts[1].strip() if len(parts) > 1 else "167054")  # your club ID as default
+                reply = await EA_POOL.run(lambda: ea_health_check(test_id),
+                                          command_priority(tags))
+                await self.privmsg(reply)
+        except Exception as e:
+            print(f"[IRC-WS Command Error] {e}")
 
     async def _send_raw(self, line: str):
-        if self.ws is not None:
-            await self.ws.send_str(line + "\r\n")
+        if self._active is not None:
+            await self._active.send(line)
 
     async def privmsg(self, text: str):
         await self._send_raw(f"PRIVMSG #{self.channel} :{text}")
@@ -339,6 +613,103 @@ class SpotifyClient:
                 "progress_ms": j.get("progress_ms", 0),
             }
 
+# --- Now-playing history (filled by spotify_loop, read by chat commands; no API calls) ---
+class TrackEntry:
+    __slots__ = ("id", "title", "artists", "started_at", "announced", "live")
+
+    def __init__(self, id, title, artists, started_at, announced=False, live=False):
+        self.id = id
+        self.title = title
+        self.artists = artists
+        self.started_at = started_at    # epoch seconds
+        self.announced = announced      # announcement sent to chat
+        self.live = live                # False = played while stream was offline
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+class TrackHistory:
+    def __init__(self, maxlen: int = 20, path: str | None = None):
+        """
+        Bounded ring buffer of recently played tracks (newest last).
+        path: optional JSON file the buffer is saved to / restored from.
+        """
+        self._entries: deque[TrackEntry] = deque(maxlen=max(1, maxlen))
+        self._path = path
+        self.playing = False            # is the newest entry still playing?
+        self._load()
+
+    def _load(self):
+        if not self._path or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                for d in json.load(f):
+                    self._entries.append(TrackEntry(**{k: d.get(k) for k in TrackEntry.__slots__}))
+            print(f"[History] Restored {len(self._entries)} tracks from {self._path}")
+        except Exception as e:
+            print(f"[History] Failed to load {self._path}: {e}")
+
+    def _save(self):
+        if not self._path:
+            return
+        try:
+            tmp = self._path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump([e.to_dict() for e in self._entries], f, ensure_ascii=False)
+            os.replace(tmp, self._path)
+        except Exception as e:
+            print(f"[History] Failed to save {self._path}: {e}")
+
+    def record(self, track: dict, announced: bool = False, live: bool = False) -> TrackEntry:
+        last = self._entries[-1] if self._entries else None
+        if last is not None and last.id == track["id"]:
+            # Same track as the newest entry (e.g. still playing after a restart restored it)
+            last.announced = last.announced or announced
+            last.live = last.live or live
+            self.playing = True
+            self._save()
+            return last
+        entry = TrackEntry(track["id"], track["title"], track["artists"],
+                           time.time() - track.get("progress_ms", 0) / 1000, announced, live)
+        self._entries.append(entry)
+        self.playing = True
+        self._save()
+        return entry
+
+    def mark_stopped(self):
+        self.playing = False
+
+    def mark_playing(self):
+        self.playing = True
+
+    def mark_announced(self, entry: TrackEntry):
+        entry.announced = True
+        self._save()
+
+    def current(self) -> TrackEntry | None:
+        return self._entries[-1] if (self.playing and self._entries) else None
+
+    def recent(self, n: int = 5) -> list[TrackEntry]:
+        """Newest first."""
+        n = max(0, min(n, len(self._entries)))
+        return [self._entries[-i] for i in range(1, n + 1)]
+
+def format_song_reply(history: TrackHistory) -> str:
+    cur = history.current()
+    if not cur:
+        return "🎶 Nothing playing right now."
+    return f"🎶 Now Playing: {cur.title} — {cur.artists}"
+
+def format_lastsongs_reply(history: TrackHistory, n: int = 5) -> str:
+    items = history.recent(n + 1 if history.current() else n)
+    if history.current():
+        items = items[1:]   # skip the one currently playing
+    if not items:
+        return "🎶 No previous songs yet."
+    listing = " | ".join(f"{i+1}) {e.title} — {e.artists}" for i, e in enumerate(items))
+    return f"🎶 Last songs: {listing}"[:480]
+
 # --- EA Pro Clubs helpers (aiohttp) ---
 EA_BASE = "https://proclubs.ea.com/api/fc"
 
@@ -349,14 +720,16 @@ def _streak_emoji(v):
     except:
         return "❓"
 
+_EA_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
+    "Accept": "application/json, text/plain, */*",
+    "Referer": "https://www.ea.com/",
+    "Origin": "https://www.ea.com",
+}
+
 # --- Robust HTTP JSON fetch with better diagnostics ---
 async def _http_json(session, url, headers=None):
-    h = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
-        "Accept": "application/json, text/plain, */*",
-        "Referer": "https://www.ea.com/",
-        "Origin": "https://www.ea.com",
-    }
+    h = dict(_EA_HEADERS)
     if headers:
         h.update(headers)
 
@@ -374,19 +747,106 @@ async def _http_json(session, url, headers=None):
     except Exception as e:
         print(f"[EA NET] {type(e).__name__}: {e} @ {url}")
         raise
-async def ea_search_clubs(session, name_or_id: str):
-    """Return list of leaderboard search results. If numeric, try direct id shim."""
-    if name_or_id.isdigit():
-        # Fake a 'search' style object for direct ID usage
-        return [{"clubInfo": {"clubId": int(name_or_id), "name": f"ID:{name_or_id}"}}]
-    q = name_or_id.replace(" ", "%20")
-    url = f"{EA_BASE}/allTimeLeaderboard/search?platform={PLATFORM}&clubName={q}"
+# club id -> platform it was found on, so follow-up fetches skip the search (oldest dropped first)
+_CLUB_PLATFORM: dict[str, str] = {}
+_CLUB_PLATFORM_MAX = 2000
+
+def _remember_platform(club_id, platform: str):
+    cid = str(club_id)
+    _CLUB_PLATFORM.pop(cid, None)
+    _CLUB_PLATFORM[cid] = platform
+    while len(_CLUB_PLATFORM) > _CLUB_PLATFORM_MAX:
+        _CLUB_PLATFORM.pop(next(iter(_CLUB_PLATFORM)))
+
+def ea_platform_for(club_id) -> str:
+    return _CLUB_PLATFORM.get(str(club_id), PLATFORM)
+
+def _club_activity(c: dict) -> int:
+    try:
+        games = int(c.get("gamesPlayed") or 0)
+        return games or sum(int(c.get(k) or 0) for k in ("wins", "losses", "ties"))
+    except (TypeError, ValueError):
+        return 0
+
+def _rank_search_results(query: str, results: list[dict]) -> list[dict]:
+    """Best name match first; activity (games played) breaks near-ties."""
+    q = query.strip().lower()
+
+    def score(c):
+        name = c.get("clubInfo", {}).get("name", "").strip().lower()
+        similarity = 1.0 if name == q else fuzz.WRatio(q, name) / 100
+        activity = min(1.0, math.log10(1 + _club_activity(c)) / 3)     # ~1000 games saturates
+        return similarity + 0.15 * activity
+
+    return sorted(results, key=score, reverse=True)
+
+_CLUB_REF_RE = re.compile(r"^(\d+)(?:@([a-z0-9-]+))?$", re.IGNORECASE)
+
+def parse_club_ref(text: str) -> tuple[str, str | None] | None:
+    """'123456' or '123456@common-gen4' (as shown in listings) -> (club id, platform or None)."""
+    m = _CLUB_REF_RE.match(text.strip())
+    if not m:
+        return None
+    return m.group(1), (m.group(2).lower() if m.group(2) else None)
+
+def _club_choice_label(c: dict) -> str:
+    info = c["clubInfo"]
+    plat = c.get("platform")
+    suffix = f"@{plat}" if plat and plat != PLATFORM else ""
+    return f"{info['name']}[{info['clubId']}{suffix}]"
+
+async def _search_platform(session, name: str, platform: str) -> list[dict]:
+    q = name.replace(" ", "%20")
+    url = f"{EA_BASE}/allTimeLeaderboard/search?platform={platform}&clubName={q}"
     data = await _http_json(session, url)
-    # Filter out EA's 'None of these'
-    return [c for c in data if c.get("clubInfo", {}).get("name", "").strip().lower() != "none of these"]
+    out = []
+    for c in data if isinstance(data, list) else []:
+        # Filter out EA's 'None of these'
+        if c.get("clubInfo", {}).get("name", "").strip().lower() == "none of these":
+            continue
+        c["platform"] = platform
+        out.append(c)
+    return out
 
-async def ea_club_stats(session, club_id: str):
-    url = f"{EA_BASE}/clubs/overallStats?platform={PLATFORM}&clubIds={club_id}"
+async def ea_search_clubs(session, name_or_id: str):
+    """
+    Return leaderboard search results from every platform in EA_PLATFORMS, merged and ranked.
+    Each result carries its "platform"; a club id (optionally 'id@platform') skips the search.
+    """
+    ref = parse_club_ref(name_or_id)
+    if ref:
+        club_id, platform = ref
+        # Fake a 'search' style object for direct ID usage
+        return [{"clubInfo": {"clubId": int(club_id), "name": f"ID:{club_id}"},
+                 "platform": platform or ea_platform_for(club_id)}]
+
+    per_platform = await asyncio.gather(*(_search_platform(session, name_or_id, p) for p in EA_PLATFORMS),
+                                        return_exceptions=True)
+    errors = [r for r in per_platform if isinstance(r, BaseException)]
+    if errors and len(errors) == len(per_platform):
+        raise errors[0]
+
+    merged, seen = [], set()
+    for res in per_platform:
+        if isinstance(res, BaseException):
+            continue
+        for c in res:
+            key = (c["platform"], str(c.get("clubInfo", {}).get("clubId")))
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append(c)
+
+    ranked = _rank_search_results(name_or_id, merged)
+    # Remember lower-ranked first so the best match wins if an id exists on two platforms,
+    # except that PLATFORM always wins: its clubs are listed without an @platform suffix
+    for c in sorted(reversed(ranked), key=lambda c: c["platform"] == PLATFORM):
+        _remember_platform(c["clubInfo"]["clubId"], c["platform"])
+    return ranked
+
+async def ea_club_stats(session, club_id: str, platform: str | None = None):
+    platform = platform or ea_platform_for(club_id)
+    url = f"{EA_BASE}/clubs/overallStats?platform={platform}&clubIds={club_id}"
     data = await _http_json(session, url)
     club = data[0] if isinstance(data, list) and data else {}
     return {
@@ -399,71 +859,137 @@ async def ea_club_stats(session, club_id: str):
         "skillRating": club.get("skillRating", "N/A"),
     }
 
-async def ea_recent_form(session, club_id: str, n=5):
-    base = f"{EA_BASE}/clubs/matches"
-    forms = []
-    all_matches = []
-    for t in ("leagueMatch", "playoffMatch"):
-        url = f"{base}?matchType={t}&platform={PLATFORM}&clubIds={club_id}"
-        try:
-            all_matches += await _http_json(session, url)
-        except Exception:
-            pass
-    all_matches.sort(key=lambda x: x.get("timestamp", 0), reverse=True)
-    for m in all_matches[:n]:
-        clubs = m.get("clubs", {})
-        c = clubs.get(str(club_id), {})
-        opp_id = next((cid for cid in clubs if cid != str(club_id)), None)
-        o = clubs.get(opp_id, {}) if opp_id else {}
-        us = int(c.get("goals", 0))
-        them = int(o.get("goals", 0)) if o else 0
-        forms.append("✅" if us > them else "❌" if us < them else "➖")
-    return forms
-
-async def ea_last_match_line(session, club_id: str):
-    base = f"{EA_BASE}/clubs/matches"
-    all_matches = []
-    for t in ("leagueMatch", "playoffMatch"):
-        url = f"{base}?matchType={t}&platform={PLATFORM}&clubIds={club_id}"
-        try:
-            all_matches += await _http_json(session, url)
-        except Exception:
-            pass
-    if not all_matches:
-        return "Last: n/a"
-    all_matches.sort(key=lambda x: x.get("timestamp", 0), reverse=True)
-    m = all_matches[0]
+# --- Streaming match decoding: one array element in memory at a time, compact records out ---
+async def _iter_json_array(session, url, headers=None, chunk_size=16384):
+    """
+    Yield the elements of a top-level JSON array as they arrive, without holding
+    the whole response (or the whole decoded list) in memory.
+    """
+    h = dict(_EA_HEADERS)
+    if headers:
+        h.update(headers)
+    dec = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    ws = " \t\r\n,"
+
+    try:
+        async with session.get(url, headers=h, timeout=20) as r:
+            if r.status != 200:
+                txt = await r.text()
+                print(f"[EA HTTP] {r.status} for {url}\nBody: {txt[:400]}")
+                raise RuntimeError(f"HTTP {r.status}")
+
+            buf, pos = "", 0
+            started = done = eof = False
+            need = 0        # don't retry a partial element until the buffer has grown to this size
+            chunks = r.content.iter_chunked(chunk_size)
+            while not (done or eof):
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    chunk, eof, need = b"", True, 0     # last chance to decode what's buffered
+                buf += utf8.decode(chunk, final=eof)
+                while True:
+                    while pos < len(buf) and buf[pos] in ws:
+                        pos += 1
+                    if pos >= len(buf):
+                        break
+                    if not started:
+                        if buf[pos] != "[":
+                            print(f"[EA JSON] Expected a list from {url} | body head: {buf[pos:pos + 400]}")
+                            return
+                        started = True
+                        pos += 1
+                        continue
+                    if buf[pos] == "]":
+                        done = True
+                        break
+                    if len(buf) - pos < need:
+                        break
+                    try:
+                        obj, end = dec.raw_decode(buf, pos)
+                    except json.JSONDecodeError:
+                        need = 2 * (len(buf) - pos)     # element incomplete; wait for more data
+                        break
+                    if buf[pos] not in '{["' and not eof and (end == len(buf) or buf[end] not in ws + "]"):
+                        need = len(buf) - pos + 1       # a number may continue in the next chunk
+                        break
+                    pos, need = end, 0
+                    yield obj
+                buf, pos = buf[pos:], 0
+            if not done:
+                print(f"[EA JSON] Truncated list from {url} | tail: {buf[-400:]}")
+                raise RuntimeError("Bad JSON")
+    except Exception as e:
+        print(f"[EA NET] {type(e).__name__}: {e} @ {url}")
+        raise
+
+class MatchRecord:
+    """The few fields the chat commands use from a match, seen from one club's side."""
+    __slots__ = ("timestamp", "goals_for", "goals_against", "opp_name")
+
+    def __init__(self, timestamp, goals_for, goals_against, opp_name):
+        self.timestamp = timestamp          # epoch seconds (UTC)
+        self.goals_for = goals_for
+        self.goals_against = goals_against
+        self.opp_name = opp_name
+
+    @property
+    def badge(self) -> str:
+        return "✅" if self.goals_for > self.goals_against else "❌" if self.goals_for < self.goals_against else "➖"
+
+def _decode_match(m: dict, club_id: str) -> MatchRecord:
     clubs = m.get("clubs", {})
     c = clubs.get(str(club_id), {})
     opp_id = next((cid for cid in clubs if cid != str(club_id)), None)
     o = clubs.get(opp_id, {}) if opp_id else {}
-    our = int(c.get("goals", 0))
-    their = int(o.get("goals", 0) if o else 0)
-    opp_name = (o.get("details") or {}).get("name") or o.get("name") or "Unknown"
-    badge = "✅" if our > their else "❌" if our < their else "➖"
-    return f"Last: {badge} vs {opp_name} ({our}-{their})"
+    return MatchRecord(
+        int(m.get("timestamp") or 0),
+        int(c.get("goals", 0)),
+        int(o.get("goals", 0)) if o else 0,
+        (o.get("details") or {}).get("name") or o.get("name") or "Unknown",
+    )
 
-async def ea_days_since_last(session, club_id: str):
+async def ea_club_matches(session, club_id: str, platform: str | None = None) -> list[MatchRecord]:
+    """League + playoff matches for club_id as compact records, newest first."""
     base = f"{EA_BASE}/clubs/matches"
-    all_matches = []
-    for t in ("leagueMatch", "playoffMatch"):
-        url = f"{base}?matchType={t}&platform={PLATFORM}&clubIds={club_id}"
+    platform = platform or ea_platform_for(club_id)
+
+    async def _fetch(match_type):
+        url = f"{base}?matchType={match_type}&platform={platform}&clubIds={club_id}"
         try:
-            all_matches += await _http_json(session, url)
+            return [_decode_match(m, club_id) async for m in _iter_json_array(session, url) if isinstance(m, dict)]
         except Exception:
-            pass
-    if not all_matches:
-        return None
-    all_matches.sort(key=lambda x: x.get("timestamp", 0), reverse=True)
-    ts = all_matches[0].get("timestamp", 0)
-    if not ts:
+            return []
+
+    league, playoff = await asyncio.gather(_fetch("leagueMatch"), _fetch("playoffMatch"))
+    matches = league + playoff
+    matches.sort(key=lambda x: x.timestamp, reverse=True)
+    return matches
+
+async def ea_recent_form(session, club_id: str, n=5, matches: list[MatchRecord] | None = None):
+    if matches is None:
+        matches = await ea_club_matches(session, club_id)
+    return [m.badge for m in matches[:n]]
+
+async def ea_last_match_line(session, club_id: str, matches: list[MatchRecord] | None = None):
+    if matches is None:
+        matches = await ea_club_matches(session, club_id)
+    if not matches:
+        return "Last: n/a"
+    m = matches[0]
+    return f"Last: {m.badge} vs {m.opp_name} ({m.goals_for}-{m.goals_against})"
+
+async def ea_days_since_last(session, club_id: str, matches: list[MatchRecord] | None = None):
+    if matches is None:
+        matches = await ea_club_matches(session, club_id)
+    if not matches or not matches[0].timestamp:
         return None
-    # ts is epoch seconds (UTC)
-    import time as _time
-    return int(( _time.time() - ts ) // 86400)
+    return int((time.time() - matches[0].timestamp) // 86400)
 
-async def ea_club_rank(session, club_id: str):
-    url = f"{EA_BASE}/allTimeLeaderboard?platform={PLATFORM}"
+async def ea_club_rank(session, club_id: str, platform: str | None = None):
+    platform = platform or ea_platform_for(club_id)
+    url = f"{EA_BASE}/allTimeLeaderboard?platform={platform}"
     try:
         data = await _http_json(session, url)
         for c in data:
@@ -498,6 +1024,92 @@ def format_versus_line(name, stats, rank, last_line, form, days):
     )
     return out[:480]  # keep a little headroom under the limit
 
+# --- EA admission control: fixed worker pool + bounded priority queue ---
+PRIO_BROADCASTER, PRIO_MOD, PRIO_VIP, PRIO_VIEWER, PRIO_BACKGROUND = range(5)
+EA_BUSY_REPLY = "⏳ Busy with other lookups right now, try again in a moment."
+
+class EABusy(Exception):
+    pass
+
+class EAWorkerPool:
+    def __init__(self, workers: int, queue_size: int):
+        """
+        At most `workers` EA jobs run at once; up to `queue_size` wait, best priority first.
+        Lower priorities get a smaller share of the queue. When a job arrives at a full queue it
+        evicts the newest queued job of a lower priority (that requester gets EABusy); only if
+        nothing queued ranks below it is the new job itself shed.
+        """
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self._heap: list[tuple] = []    # (priority, seq, factory, future)
+        self._cond: asyncio.Condition | None = None
+        self._seq = itertools.count()   # FIFO within a priority; keeps tuples comparable
+
+    def _admit_limit(self, priority: int) -> int:
+        if priority <= PRIO_MOD:
+            return self.queue_size
+        if priority == PRIO_VIP:
+            return max(1, self.queue_size * 3 // 4)
+        return max(1, self.queue_size // 2)
+
+    async def submit(self, factory, priority: int = PRIO_BACKGROUND):
+        """Queue factory() (a coroutine function) and return its result; raises EABusy if shed."""
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        for i in range(self.workers):
+            TASKS.spawn(f"ea-worker-{i}", self._worker)
+        fut = asyncio.get_running_loop().create_future()
+        async with self._cond:
+            if len(self._heap) >= self._admit_limit(priority):
+                worst = max(self._heap, default=None)    # lowest priority, newest first
+                if worst is None or worst[0] <= priority:
+                    print(f"[EA Pool] shedding priority {priority} job (queued={len(self._heap)})")
+                    raise EABusy()
+                self._heap.remove(worst)
+                heapq.heapify(self._heap)
+                print(f"[EA Pool] evicting queued priority {worst[0]} job for priority {priority}")
+                if not worst[3].done():
+                    worst[3].set_exception(EABusy())
+            heapq.heappush(self._heap, (priority, next(self._seq), factory, fut))
+            self._cond.notify()
+        return await fut
+
+    async def run(self, factory, priority: int = PRIO_BACKGROUND) -> str:
+        """submit() for chat commands: a busy reply instead of EABusy."""
+        try:
+            return await self.submit(factory, priority)
+        except EABusy:
+            return EA_BUSY_REPLY
+
+    async def _worker(self):
+        while True:
+            async with self._cond:
+                await self._cond.wait_for(lambda: self._heap)
+                _, _, factory, fut = heapq.heappop(self._heap)
+            if fut.done():      # requester gave up while queued
+                continue
+            try:
+                result = await factory()
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                if not fut.done():
+                    fut.set_result(result)
+
+EA_POOL = EAWorkerPool(EA_WORKERS, EA_QUEUE_SIZE)
+
+async def ea_health_check(test_id: str) -> str:
+    try:
+        async with aiohttp.ClientSession() as session:
+            url = f"{EA_BASE}/clubs/overallStats?platform={PLATFORM}&clubIds={test_id}"
+            data = await _http_json(session, url)
+            ok = isinstance(data, list) and len(data) > 0 and "wins" in data[0]
+            return "EA OK ✅" if ok else "EA responded, but structure unexpected ⚠️"
+    except Exception as e:
+        print(f"[EAHealth Error] {e}")
+        return "EA FAIL ❌ (see logs)"
+
 # --- Twitch-chat command handler for Pro Clubs ---
 async def handle_versus_command(argstr: str) -> str:
     args = argstr.strip()
@@ -511,23 +1123,25 @@ async def handle_versus_command(argstr: str) -> str:
             if not results:
                 return "No matching clubs found."
 
-            # 2) if non-numeric query yields multiple, list top 5 with IDs
-            if not args.isdigit() and len(results) > 1:
+            # 2) if non-numeric query yields multiple, list top 5 (best ranked first) with IDs
+            if not parse_club_ref(args) and len(results) > 1:
                 top = results[:5]
-                listing = " | ".join(f"{i+1}) {c['clubInfo']['name']}[{c['clubInfo']['clubId']}]" for i, c in enumerate(top))
+                listing = " | ".join(f"{i+1}) {_club_choice_label(c)}" for i, c in enumerate(top))
                 return f"Multiple matches: {listing} — re-run with the club ID (e.g. !versus 123456)"
 
             # 3) choose first result
             chosen = results[0]
             club_id = str(chosen['clubInfo']['clubId'])
             name    = chosen['clubInfo']['name']
+            platform = chosen.get('platform')
 
             # 4) fetch stats and compose line
-            stats     = await ea_club_stats(session, club_id)
-            form      = await ea_recent_form(session, club_id, n=5)
-            last_line = await ea_last_match_line(session, club_id)
-            days      = await ea_days_since_last(session, club_id)
-            rank      = await ea_club_rank(session, club_id)
+            stats     = await ea_club_stats(session, club_id, platform)
+            matches   = await ea_club_matches(session, club_id, platform)   # fetched once, shared below
+            form      = await ea_recent_form(session, club_id, n=5, matches=matches)
+            last_line = await ea_last_match_line(session, club_id, matches=matches)
+            days      = await ea_days_since_last(session, club_id, matches=matches)
+            rank      = await ea_club_rank(session, club_id, platform)
 
             return format_versus_line(name, stats, rank, last_line, form, days)
     except Exception as e:
@@ -538,6 +1152,180 @@ async def handle_versus_command(argstr: str) -> str:
 async def send_chat_or_announce(irc_client, message: str, force_announce: bool = False):
     await irc_client.privmsg(message)
 
+# --- Helix client: batched lookups, rate-limit aware, queued announcements ---
+HELIX_BASE = "https://api.twitch.tv/helix"
+HELIX_BATCH_SIZE = 100          # max logins/ids per users/streams request
+HELIX_RATELIMIT_RESERVE = 2     # keep a couple of points spare for urgent calls
+HELIX_ANNOUNCE_QUEUE_SIZE = 50
+
+class HelixClient:
+    def __init__(self, client_id: str, client_secret: str, user_token_plain: str):
+        """
+        client_id / client_secret: used for the app access token (users, streams)
+        user_token_plain: user token without 'oauth:' (announcements need a moderator user token)
+        """
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.user_token_plain = user_token_plain
+        self._app_token = None
+        self._app_token_exp = 0.0
+        self._token_lock = asyncio.Lock()
+        # Helix tracks a separate bucket per token: {"app"|"user": [remaining, reset_epoch, limit]}
+        # (reset_epoch is None until a response in the current window tells us)
+        self._buckets = {"app": [None, None, None], "user": [None, None, None]}
+        # Requests take budget one at a time, in arrival order, under the bucket's lock
+        self._bucket_locks = {"app": asyncio.Lock(), "user": asyncio.Lock()}
+        self._announce_queue: asyncio.Queue | None = None
+
+    async def _get_app_token(self, session: aiohttp.ClientSession) -> str:
+        """Get & cache an App Access Token (one refresh at a time)."""
+        async with self._token_lock:
+            now = time.time()
+            if self._app_token and now < (self._app_token_exp - 30):
+                return self._app_token
+            url = "https://id.twitch.tv/oauth2/token"
+            data = {
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+                "grant_type": "client_credentials",
+            }
+            async with session.post(url, data=data) as r:
+                j = await r.json()
+                if "access_token" not in j:
+                    raise RuntimeError(f"App token error: {r.status} {j}")
+                self._app_token = j["access_token"]
+                self._app_token_exp = now + j.get("expires_in", 3600)
+                print("[DEBUG] Obtained App Access Token")
+                return self._app_token
+
+    async def _take_budget(self, bucket: str) -> bool:
+        """
+        Take one point from the bucket, sleeping until the reset if it's down to the reserve.
+        Call with the bucket lock held. Returns False if the budget is unknown (send a probe).
+        """
+        state = self._buckets[bucket]
+        while True:
+            if state[0] is not None and state[1] is not None and state[1] <= time.time():
+                # Window rolled over: full budget again (None if limit unknown), new reset not known yet
+                state[0], state[1] = state[2], None
+            remaining, reset_at, limit = state
+            if remaining is None:
+                return False
+            reserve = min(HELIX_RATELIMIT_RESERVE, max(0, (limit or 0) - 1))
+            if remaining > reserve:
+                state[0] = remaining - 1    # account for the in-flight request
+                return True
+            if reset_at is None:
+                reset_at = state[1] = time.time() + 1     # responses carried no reset; assume a short window
+            delay = max(reset_at - time.time(), 0.05)
+            print(f"[Helix] {bucket} rate-limit budget low ({remaining}); waiting {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    def _update_bucket(self, bucket: str, status: int, headers):
+        state = self._buckets[bucket]
+        try:
+            state[2] = int(headers.get("Ratelimit-Limit"))
+        except (TypeError, ValueError):
+            pass
+        try:
+            remaining = int(headers.get("Ratelimit-Remaining"))
+            reset_at = float(headers.get("Ratelimit-Reset"))
+        except (TypeError, ValueError):
+            remaining = None
+        if remaining is not None and reset_at > time.time():   # ignore late replies from an expired window
+            # Budget only grows when _take_budget sees the window roll over; a response can't
+            # raise it, since it doesn't count requests admitted after it was sent
+            state[0] = remaining if state[0] is None else min(state[0], remaining)
+            state[1] = reset_at if state[1] is None else max(state[1], reset_at)
+        if status == 429:
+            state[0] = 0
+            state[1] = max(state[1] or 0.0, time.time() + 1)
+
+    async def _send(self, session: aiohttp.ClientSession, method: str, path: str, params, payload, bucket: str):
+        token = await self._get_app_token(session) if bucket == "app" else self.user_token_plain
+        headers = {"Client-Id": self.client_id, "Authorization": f"Bearer {token}"}
+        async with session.request(method, f"{HELIX_BASE}/{path}", params=params,
+                                   json=payload, headers=headers) as r:
+            self._update_bucket(bucket, r.status, r.headers)
+            return r.status, await r.text()
+
+    async def _request(self, session: aiohttp.ClientSession, method: str, path: str,
+                       params=None, payload=None, bucket: str = "app", retries: int = 2):
+        """Return (status, parsed JSON or raw text). Retries 429s after the bucket resets."""
+        for attempt in range(retries + 1):
+            async with self._bucket_locks[bucket]:
+                known = await self._take_budget(bucket)
+                if not known:
+                    # Nothing known about this bucket yet: send one request alone to learn the limit
+                    status, txt = await self._send(session, method, path, params, payload, bucket)
+            if known:
+                status, txt = await self._send(session, method, path, params, payload, bucket)
+            if attempt < retries:
+                if status == 429:
+                    print(f"[Helix] 429 on {path}; retrying after reset")
+                    continue
+                if status == 401 and bucket == "app":
+                    self._app_token = None      # expired/revoked; fetch a fresh one
+                    continue
+            try:
+                return status, json.loads(txt) if txt else None
+            except ValueError:
+                return status, txt
+
+    async def _get_batched(self, session: aiohttp.ClientSession, path: str, pairs: list[tuple[str, str]],
+                           extra: list[tuple[str, str]] | None = None) -> list[dict]:
+        out = []
+        for i in range(0, len(pairs), HELIX_BATCH_SIZE):
+            params = pairs[i:i + HELIX_BATCH_SIZE] + (extra or [])
+            status, body = await self._request(session, "GET", path, params=params)
+            if status != 200 or not isinstance(body, dict):
+                raise RuntimeError(f"Helix {path} lookup failed: {status} {body}")
+            out += body.get("data") or []
+        return out
+
+    async def get_users(self, session: aiohttp.ClientSession, logins=(), ids=()) -> list[dict]:
+        """Look up users by login and/or id, 100 per request."""
+        pairs = [("login", str(l).lower()) for l in dict.fromkeys(logins)]
+        pairs += [("id", str(i)) for i in dict.fromkeys(ids)]
+        return await self._get_batched(session, "users", pairs)
+
+    async def get_streams(self, session: aiohttp.ClientSession, user_ids) -> dict[str, dict]:
+        """Return {user_id: stream} for the ids that are live, 100 per request."""
+        pairs = [("user_id", str(u)) for u in dict.fromkeys(user_ids)]
+        streams = await self._get_batched(session, "streams", pairs, extra=[("first", str(HELIX_BATCH_SIZE))])
+        return {s["user_id"]: s for s in streams}
+
+    async def announce(self, broadcaster_id: str, moderator_id: str, text: str, color: str = "primary") -> bool:
+        """Queue an announcement; announcements go out one at a time within the user-token budget."""
+        if self._announce_queue is None:
+            self._announce_queue = asyncio.Queue(maxsize=HELIX_ANNOUNCE_QUEUE_SIZE)
+        TASKS.spawn("helix-announce", self._announce_worker)
+        params = [("broadcaster_id", str(broadcaster_id)), ("moderator_id", str(moderator_id))]
+        payload = {"message": text, "color": color}
+        fut = asyncio.get_running_loop().create_future()
+        try:
+            self._announce_queue.put_nowait((params, payload, fut))
+        except asyncio.QueueFull:
+            print("[Helix Announce] Queue full; dropping announcement")
+            return False
+        return await fut
+
+    async def _announce_worker(self):
+        async with aiohttp.ClientSession() as session:
+            while True:
+                params, payload, fut = await self._announce_queue.get()
+                ok = False
+                try:
+                    status, body = await self._request(session, "POST", "chat/announcements",
+                                                       params=params, payload=payload, bucket="user")
+                    ok = status in (200, 201, 204)
+                    if not ok:
+                        print(f"[Helix Announce Error] {status} {body}")
+                except Exception as e:
+                    print(f"[Helix Announce Error] {e}")
+                if not fut.done():
+                    fut.set_result(ok)
+
 # --- Helix + Spotify Bot (kept as-is for announcements) ---
 class Bot(commands.Bot):
     def __init__(self):
@@ -551,17 +1339,17 @@ class Bot(commands.Bot):
         )
         self.spotify = SpotifyClient(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, SPOTIFY_REFRESH_TOKEN)
         self._last_track_id = None
+        self.history = TrackHistory(SONG_HISTORY_SIZE, SONG_HISTORY_FILE)
 
         self._broadcaster_id = None
         self._user_token_plain = get_plain_user_token()
         self._helix_ready = False
+        self.helix = HelixClient(CLIENT_ID, CLIENT_SECRET, self._user_token_plain)
 
         # Our added raw IRC WS client
         self._irc_ws_client: SimpleIRCClient | None = None
 
         # --- live gating helpers ---
-        self._app_token = None
-        self._app_token_exp = 0.0
         self._live_status = None        # True/False
         self._live_checked_at = 0.0     # epoch seconds
 
@@ -579,8 +1367,10 @@ class Bot(commands.Bot):
             channels = [os.getenv("TWITCH_CHANNEL")]        # fallback from env
     
         await notify_discord_online(bot_name, channels)     # <- pass channels (optional)
-    
-        asyncio.create_task(self.bootstrap_helix_and_run())
+
+        if LOOP_LAG_THRESHOLD_MS > 0:
+            TASKS.spawn("loop-lag", LOOP_MONITOR.run)
+        TASKS.spawn("helix-bootstrap", self.bootstrap_helix_and_run, restart=False)
 
     async def bootstrap_helix_and_run(self):
         async with aiohttp.ClientSession() as session:
@@ -593,7 +1383,7 @@ class Bot(commands.Bot):
 
             # Startup announcement via Helix
             try:
-                ok = await self._helix_announce(session, "✅ StimoBot is online and watching Spotify 🎶", "green")
+                ok = await self._helix_announce("✅ StimoBot is online and watching Spotify 🎶", "green")
                 self._helix_ready = ok
                 if ok:
                     print("[DEBUG] Helix startup announcement sent")
@@ -604,57 +1394,28 @@ class Bot(commands.Bot):
 
         # Start our own IRC-WS client to guarantee viewer-list presence
         try:
-            # Validate token (again) to get the login for NICK
-            tv = await validate_token(TOKEN)
-            nick = tv.get("login") if tv else None
-            if not nick:
-                nick = "stimobot"
-                print("[IRC-WS] Warning: could not determine login from token; defaulting to 'stimobot'.")
-            self._irc_ws_client = SimpleIRCClient(token_oauth=TOKEN, login=nick, channel=CHANNEL)
-            asyncio.create_task(self._irc_ws_client.connect_and_run())
+            # Reuse the client if event_ready fires again (twitchio reconnect)
+            if self._irc_ws_client is None:
+                # Validate token (again) to get the login for NICK
+                tv = await validate_token(TOKEN)
+                nick = tv.get("login") if tv else None
+                if not nick:
+                    nick = "stimobot"
+                    print("[IRC-WS] Warning: could not determine login from token; defaulting to 'stimobot'.")
+                self._irc_ws_client = SimpleIRCClient(token_oauth=TOKEN, login=nick, channel=CHANNEL,
+                                                      history=self.history)
+            TASKS.spawn("irc-ws", self._irc_ws_client.connect_and_run)
         except Exception as e:
             print(f"[IRC-WS] Failed to start IRC WS client: {e}")
 
         # Start Spotify loop
-        asyncio.create_task(self.spotify_loop())
+        TASKS.spawn("spotify", self.spotify_loop)
 
     async def _resolve_broadcaster_id(self, session: aiohttp.ClientSession, login_name: str) -> str:
-        token_url = "https://id.twitch.tv/oauth2/token"
-        data = {"client_id": CLIENT_ID, "client_secret": CLIENT_SECRET, "grant_type": "client_credentials"}
-        async with session.post(token_url, data=data) as r:
-            tok = await r.json()
-            if "access_token" not in tok:
-                raise RuntimeError(f"Failed to get app token: {tok}")
-            app_token = tok["access_token"]
-            print("[DEBUG] Obtained Twitch app access token")
-
-        users_url = f"https://api.twitch.tv/helix/users?login={login_name}"
-        headers = {"Client-Id": CLIENT_ID, "Authorization": f"Bearer {app_token}"}
-        async with session.get(users_url, headers=headers) as r:
-            j = await r.json()
-            if r.status != 200 or "data" not in j or not j["data"]:
-                raise RuntimeError(f"Helix users lookup failed: {r.status} {j}")
-            return j["data"][0]["id"]
-
-    async def _get_app_token(self, session: aiohttp.ClientSession) -> str:
-        """Get & cache an App Access Token for GET /streams live check."""
-        now = time.time()
-        if self._app_token and now < (self._app_token_exp - 30):
-            return self._app_token
-        url = "https://id.twitch.tv/oauth2/token"
-        data = {
-            "client_id": CLIENT_ID,
-            "client_secret": CLIENT_SECRET,
-            "grant_type": "client_credentials",
-        }
-        async with session.post(url, data=data) as r:
-            j = await r.json()
-            if "access_token" not in j:
-                raise RuntimeError(f"App token error: {r.status} {j}")
-            self._app_token = j["access_token"]
-            self._app_token_exp = now + j.get("expires_in", 3600)
-            print("[DEBUG] Obtained App Access Token (for streams)")
-            return self._app_token
+        users = await self.helix.get_users(session, logins=[login_name])
+        if not users:
+            raise RuntimeError(f"Helix users lookup returned no user for {login_name}")
+        return users[0]["id"]
 
     async def _is_stream_live(self, session: aiohttp.ClientSession, cache_seconds: int = 60) -> bool:
         """Return True if the channel is live. Cached for cache_seconds."""
@@ -664,56 +1425,38 @@ class Bot(commands.Bot):
         if not self._broadcaster_id:
             return False
 
-        token = await self._get_app_token(session)
-        headers = {"Client-Id": CLIENT_ID, "Authorization": f"Bearer {token}"}
-        url = f"https://api.twitch.tv/helix/streams?user_id={self._broadcaster_id}"
-        async with session.get(url, headers=headers) as r:
-            if r.status != 200:
-                txt = await r.text()
-                print(f"[DEBUG] streams check failed: {r.status} {txt}")
-                self._live_status = False
-            else:
-                data = await r.json()
-                self._live_status = bool(data.get("data"))
+        try:
+            streams = await self.helix.get_streams(session, [self._broadcaster_id])
+            self._live_status = str(self._broadcaster_id) in streams
+        except Exception as e:
+            print(f"[DEBUG] streams check failed: {e}")
+            self._live_status = False
         self._live_checked_at = now
         print(f"[DEBUG] Live status: {self._live_status}")
         return self._live_status
 
-    async def _helix_announce(self, session: aiohttp.ClientSession, text: str, color: str = "primary") -> bool:
-        """Send a Twitch announcement (colored highlight)."""
+    async def _helix_announce(self, text: str, color: str = "primary") -> bool:
+        """Send a Twitch announcement (colored highlight) through the rate-limited queue."""
         if not (self._broadcaster_id and BOT_ID and self._user_token_plain and CLIENT_ID):
             return False
-
-        url = "https://api.twitch.tv/helix/chat/announcements"
-        headers = {
-            "Client-Id": CLIENT_ID,
-            "Authorization": f"Bearer {self._user_token_plain}",
-            "Content-Type": "application/json",
-        }
-        payload = {
-            "broadcaster_id": str(self._broadcaster_id),
-            "moderator_id": str(BOT_ID),
-            "message": text,
-            "color": color
-        }
-        async with session.post(url, headers=headers, json=payload) as r:
-            if r.status in (200, 201, 204):
-                return True
-            body = await r.text()
-            print(f"[Helix Announce Error] {r.status} {body}")
-            return False
+        return await self.helix.announce(self._broadcaster_id, BOT_ID, text, color)
 
     async def spotify_loop(self):
         async with aiohttp.ClientSession() as session:
             while True:
                 try:
                     track = await self.spotify.get_current_track(session)
+                    if not track:
+                        self.history.mark_stopped()
+                    elif track["id"] == self._last_track_id and not self.history.playing:
+                        self.history.mark_playing()     # resumed after a pause; no new entry
 
                     # gate announcements to live streams only (cached 60s)
                     is_live = await self._is_stream_live(session, cache_seconds=60)
                     if not is_live:
                         if track and track["id"] != self._last_track_id:
                             self._last_track_id = track["id"]
+                            self.history.record(track, announced=False, live=False)
                             print("[DEBUG] Track changed while OFFLINE; not announcing.")
                         else:
                             print("[DEBUG] Stream offline; skipping announcement")
@@ -732,60 +1475,16 @@ class Bot(commands.Bot):
                         self._last_track_id = track["id"]
                         msg = f"🎶 𝐍𝐨𝐰 𝐏𝐥𝐚𝐲𝐢𝐧𝐠: {track['title']} — {track['artists']}"
                         print(f"[DEBUG] Sending announcement (LIVE): {msg}")
-                        await self._helix_announce(session, msg, "purple")
+                        # Record first: the announce queue may wait for the rate limit to reset
+                        entry = self.history.record(track, announced=False, live=True)
+                        if await self._helix_announce(msg, "purple"):
+                            self.history.mark_announced(entry)
                     else:
                         print("[DEBUG] No new track or nothing playing")
                 except Exception as e:
                     print(f"[Spotify Error] {e}")
                 await asyncio.sleep(POLL_SECONDS)
 
-    @commands.command(name="versus", aliases=["vs"])
-    async def versus_cmd(self, ctx: commands.Context, *args):
-        if DISABLE_VERSUS:
-            return await ctx.send("⚠️ !vs/!versus is temporarily disabled.")
-    
-        """
-        Usage:
-          !versus <club name>
-          !versus <club id>
-        """
-        if not args:
-            return await ctx.send("Usage: !versus <club name or club id>")
-    
-        query = " ".join(args).strip()
-        try:
-            async with aiohttp.ClientSession() as session:
-                # 1) search
-                results = await ea_search_clubs(session, query)
-                if not results:
-                    return await ctx.send("No matching clubs found.")
-
-                # If multiple club-name matches and the user passed a non-numeric query,
-                # list top 5 options with IDs so chatter can re-run with an ID.
-                if not query.isdigit() and len(results) > 1:
-                    top = results[:5]
-                    listing = " | ".join(f"{i+1}) {c['clubInfo']['name']}[{c['clubInfo']['clubId']}]" for i, c in enumerate(top))
-                    return await ctx.send(f"Multiple matches: {listing} — re-run with the club ID (e.g. !versus 123456)")
-
-                # 2) pick the one
-                chosen = results[0]
-                club_id = str(chosen["clubInfo"]["clubId"])
-                name = chosen["clubInfo"]["name"]
-
-                # 3) pull stats + lines
-                stats = await ea_club_stats(session, club_id)
-                form = await ea_recent_form(session, club_id, n=5)
-                last_line = await ea_last_match_line(session, club_id)
-                days = await ea_days_since_last(session, club_id)
-                rank = await ea_club_rank(session, club_id)
-
-                # 4) print compact line
-                line = format_versus_line(name, stats, rank, last_line, form, days)
-                await ctx.send(line)
-        except Exception as e:
-            print(f"[versus] error: {e}")
-            await ctx.send("Error fetching opponent stats. Try again in a moment.")
-
 # --- Run bot ---
 if __name__ == "__main__":
     print("=== Environment Debug ===")